@@ -80,6 +80,6 @@ def generate_body():
 
 
 def parse_data(data):
-    gd = cast(data, POINTER(GSOData)).contents
+    gd = GSOData.from_buffer_copy(data)
     features = parse_features(gd.gso_type)
     return f" (len: {gd.len} gso_size: {gd.gso_size} gso_segs: {gd.gso_segs} gso_type: {features})"
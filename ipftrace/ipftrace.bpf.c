@@ -227,12 +227,15 @@ match(struct pt_regs *ctx, struct sk_buff *skb, struct event_data *e)
   return true;
 }
 
-BPF_PERF_OUTPUT(events);
+/*
+ * Single MPSC ring shared by all CPUs (4MiB). Requires Linux >= 5.8.
+ */
+BPF_RINGBUF_OUTPUT(events, 1024);
 
 static inline void
 output(struct pt_regs *ctx, struct event_data *e)
 {
-  events.perf_submit(ctx, e, sizeof(*e));
+  events.ringbuf_output(e, sizeof(*e), 0);
 }
 
 /*
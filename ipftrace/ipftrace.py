@@ -4,72 +4,77 @@
 #
 import os
 import re
+import time
 import yaml
 import click
 import socket
-import argparse
-import textwrap
+import struct
+import typing
 import tabulate
 import importlib
-import ipaddress
-import subprocess
 import dataclasses
 from bcc import BPF
-from ctypes import *
+from ctypes import string_at
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+# ETH_P_IP / ETH_P_IPV6 in network byte order, as the BPF side
+# reports them in event_data.l3_protocol
+L3_PROTO_IPV4 = 0x0008
+L3_PROTO_IPV6 = 0xDD86
 
 # Protocol name <=> Protocol number mapping
 PROTO_TO_ID = {}
 ID_TO_PROTO = {}
 
+# Matches "<name> <number> <alias>" lines of /etc/protocols
+PROTO_LINE = re.compile(rb"^([^#\s]\S*)\s+(\d+)\s+(\S+)", re.M)
 
-def init_protocol_mapping():
-    for line in open("/etc/protocols"):
-        spl = line.split()
-        if len(spl) == 0 or spl[0] == "#":
-            continue
-        PROTO_TO_ID[spl[2]] = spl[1]
-        ID_TO_PROTO[spl[1]] = spl[2]
-
-
-class V4Addrs(Structure):
-    _fields_ = [("saddr", c_uint32), ("daddr", c_uint32)]
-
-
-class V6Addrs(Structure):
-    _fields_ = [("saddr", c_uint8 * 16), ("daddr", c_uint8 * 16)]
-
-
-class IPAddrs(Union):
-    _fields_ = [("v4", V4Addrs), ("v6", V6Addrs)]
 
-
-class EventData(Structure):
-    _anonymous = "addrs"
-    _fields_ = [
-        ("tstamp", c_uint64),
-        ("faddr", c_uint64),
-        ("l4_protocol", c_uint8),
-        ("l3_protocol", c_uint16),
-        ("addrs", IPAddrs),
-        ("sport", c_uint16),
-        ("dport", c_uint16),
-        ("data", c_uint8 * 64),
-    ]
+def init_protocol_mapping():
+    data = open("/etc/protocols", "rb").read()
+    for _name, num, alias in PROTO_LINE.findall(data):
+        PROTO_TO_ID[alias.decode("ascii")] = num.decode("ascii")
+        ID_TO_PROTO[int(num)] = alias.decode("ascii")
 
 
-@dataclasses.dataclass(eq=True, frozen=True)
-class Flow:
-    l4_protocol: str
-    saddr: str
-    daddr: str
+# Binary layout of struct event_data in ipftrace.bpf.c
+#
+# tstamp (u64), faddr (u64), l4_protocol (u8), pad (1 byte),
+# l3_protocol (u16), address union (32 bytes), sport (u16),
+# dport (u16), data (64 bytes)
+#
+# The address union is kept as a raw blob and decoded depending on
+# the L3 protocol.
+EVENT_STRUCT = struct.Struct("<QQBxH32sHH64s")
+EVENT_SIZE = EVENT_STRUCT.size
+
+
+class Flow(typing.NamedTuple):
+    #
+    # Keep the raw integers and network order bytes taken from the
+    # event in here, so that keying the flows dict is cheap. Name
+    # resolution and address formatting only happen on printing.
+    #
+    l3_protocol: int
+    l4_protocol: int
+    saddr: bytes
+    daddr: bytes
     sport: int = 0
     dport: int = 0
 
     def __str__(self):
-        src = self.saddr + (":" + str(self.sport) if self.sport != 0 else "")
-        dst = self.daddr + (":" + str(self.dport) if self.dport != 0 else "")
-        return f"{self.l4_protocol}\t{src}\t->\t{dst}"
+        af = socket.AF_INET if self.l3_protocol == L3_PROTO_IPV4 else socket.AF_INET6
+        saddr = socket.inet_ntop(af, self.saddr)
+        daddr = socket.inet_ntop(af, self.daddr)
+        l4_proto = ID_TO_PROTO.get(self.l4_protocol, f"Unknown({self.l4_protocol})")
+        src = saddr + (":" + str(socket.ntohs(self.sport)) if self.sport != 0 else "")
+        dst = daddr + (":" + str(socket.ntohs(self.dport)) if self.dport != 0 else "")
+        return f"{l4_proto}\t{src}\t->\t{dst}"
 
 
 @dataclasses.dataclass(eq=True, frozen=True)
@@ -103,16 +108,25 @@ class IPFTracer:
         self, iv, saddr, daddr, proto, sport, dport, module, regex, length, manifest
     ):
         self._opts = self._build_opts(iv, saddr, daddr, proto, sport, dport)
+        #
+        # The -iv option fixes the L3 protocol at BPF build time, so
+        # the event parser doesn't need to branch on it per event.
+        #
+        self._addr_len = 4 if iv == "4" else 16
         self._functions = self._read_manifest(manifest)
         self._module = self._load_module(module)
-        self._regex = regex
+        self._regex = re.compile(regex) if regex != None else None
         self._length = length
         self._egress_functions = []
         self._flows = {}
+        self._event_buf = bytearray()
+        self._flow_cache = {}
+        self._fname_cache = {}
+        self._pending_output = []
 
     def _read_manifest(self, manifest):
         with open(manifest) as f:
-            return yaml.load(f, Loader=yaml.FullLoader)["functions"]
+            return yaml.load(f, Loader=YamlLoader)["functions"]
 
     def _load_module(self, module_path):
         if module_path is None:
@@ -127,8 +141,7 @@ class IPFTracer:
         return module
 
     def _inet_addr4(self, addr):
-        a = ipaddress.IPv4Address(addr).packed
-        return str(int.from_bytes(a, byteorder="little"))
+        return str(struct.unpack("<I", socket.inet_aton(addr))[0])
 
     def _build_addr4_opt(self, addr, direction):
         if addr == "any":
@@ -137,9 +150,8 @@ class IPFTracer:
             return ["-D", direction + "ADDRV4=" + self._inet_addr4(addr)]
 
     def _inet_addr6(self, addr):
-        p = ipaddress.IPv6Address(addr).packed
-        a = ",".join(list(map(lambda b: str(b), p)))
-        return a
+        p = socket.inet_pton(socket.AF_INET6, addr)
+        return ",".join(map(str, p))
 
     def _build_addr6_opt(self, addr, direction):
         if addr == "any":
@@ -149,11 +161,11 @@ class IPFTracer:
 
     def _build_ip_opt(self, iv, saddr, daddr):
         if iv == "4":
-            ret = ["-D", "L3_PROTO=0x0008"]
+            ret = ["-D", f"L3_PROTO={L3_PROTO_IPV4:#06x}"]
             ret += self._build_addr4_opt(saddr, "S")
             ret += self._build_addr4_opt(daddr, "D")
         elif iv == "6":
-            ret = ["-D", "L3_PROTO=0xdd86"]
+            ret = ["-D", f"L3_PROTO={L3_PROTO_IPV6:#06x}"]
             ret += self._build_addr6_opt(saddr, "S")
             ret += self._build_addr6_opt(daddr, "D")
         else:
@@ -186,13 +198,14 @@ class IPFTracer:
         bpf_hdr = os.path.join(os.path.dirname(__file__), "ipftrace.bpf.h")
         bpf_src = os.path.join(os.path.dirname(__file__), "ipftrace.bpf.c")
 
-        prog = ""
-        prog += open(bpf_hdr).read()
-        prog += self._module.generate_header()
-        prog += open(bpf_src).read()
-        prog += self._module.generate_body()
-
-        return prog
+        return "".join(
+            [
+                open(bpf_hdr).read(),
+                self._module.generate_header(),
+                open(bpf_src).read(),
+                self._module.generate_body(),
+            ]
+        )
 
     def _attach_probes(self):
         probes = self._build_bpf_prog()
@@ -208,7 +221,7 @@ class IPFTracer:
                 )
                 exit(1)
 
-            if self._regex != None and not re.match(self._regex, name):
+            if self._regex != None and not self._regex.match(name):
                 continue
 
             try:
@@ -224,33 +237,17 @@ class IPFTracer:
     def list_functions(self):
         for f in self._functions:
             name = f["name"]
-            if self._regex != None and not re.match(self._regex, name):
+            if self._regex != None and not self._regex.match(name):
                 continue
             print(f"{name}")
 
-    def _parse_l3_proto(self, event):
-        if event.l3_protocol == 0x0008:  # IPv4
-            saddr = ipaddress.IPv4Address(socket.ntohl(event.addrs.v4.saddr))
-            daddr = ipaddress.IPv4Address(socket.ntohl(event.addrs.v4.daddr))
-        elif event.l3_protocol == 0xDD86:  # IPv6
-            saddr = ipaddress.IPv6Address(bytes(event.addrs.v6.saddr))
-            daddr = ipaddress.IPv6Address(bytes(event.addrs.v6.daddr))
-        else:
-            print(f"Unsupported l3 protocol {event.l3_protocol}")
-            exit(1)
-
-        return (str(saddr), str(daddr))
-
-    def _parse_l4_proto(self, event):
-        p = str(event.l4_protocol)
-        l4_proto = ID_TO_PROTO.get(p, f"Unknown({p})")
-        sport = socket.ntohs(event.sport)
-        dport = socket.ntohs(event.dport)
-        return (l4_proto, sport, dport)
+    def _parse_addrs(self, addrs):
+        n = self._addr_len
+        return (addrs[:n], addrs[n : n * 2])
 
-    def _parse_custom_data(self, event):
+    def _parse_custom_data(self, data):
         try:
-            custom_data = self._module.parse_data(event.data)
+            custom_data = self._module.parse_data(data)
         except Exception as e:
             print(e)
             custom_data = ""
@@ -264,46 +261,98 @@ class IPFTracer:
         print(tabulate.tabulate(table, header, tablefmt="plain"))
         print("")
 
-    def _handle_lost(self, lost):
-        self._flows.clear()
+    def _make_event_callback(self):
+        #
+        # Just copy the raw bytes out of the ring in the callback. All
+        # of the parsing happens in _process_events after the ring is
+        # drained. bcc invokes the callback once per event, so bind
+        # everything it needs as locals up front.
+        #
+        extend = self._event_buf.extend
+
+        def handle_event(ctx, data, size):
+            extend(string_at(data, EVENT_SIZE))
+
+        return handle_event
+
+    def _process_events(self):
+        if len(self._event_buf) == 0:
+            return
+
+        for ev in EVENT_STRUCT.iter_unpack(self._event_buf):
+            tstamp, faddr, l4p, l3p, addrs, sport, dport, data = ev
+
+            #
+            # The same function and the same flow repeat endlessly in
+            # the trace, so resolve the symbol and build the Flow only
+            # on the first time we see them.
+            #
+            fname = self._fname_cache.get(faddr)
+            if fname is None:
+                fname = BPF.ksym(faddr).decode("utf-8")
+                self._fname_cache[faddr] = fname
+
+            flow = self._flow_cache.get(ev[2:7])
+            if flow is None:
+                saddr, daddr = self._parse_addrs(addrs)
+                flow = Flow(
+                    l3_protocol=l3p, l4_protocol=l4p, saddr=saddr,
+                    daddr=daddr, sport=sport, dport=dport,
+                )
+                self._flow_cache[ev[2:7]] = flow
 
-    def _handle_event(self, cpu, data, size):
-        event = cast(data, POINTER(EventData)).contents
+            custom_data = self._parse_custom_data(data)
 
-        fname = BPF.ksym(event.faddr).decode("utf-8")
-        tstamp = str(event.tstamp)
-        saddr, daddr = self._parse_l3_proto(event)
-        l4_proto, sport, dport = self._parse_l4_proto(event)
-        custom_data = self._parse_custom_data(event)
+            event_logs = self._flows.get(flow, [])
+            event_logs.append(EventLog(str(tstamp), fname, custom_data))
+            self._flows[flow] = event_logs
 
-        flow = Flow(
-            l4_protocol=l4_proto, saddr=saddr, daddr=daddr, sport=sport, dport=dport,
-        )
+            #
+            # Print the function trace if
+            #
+            # 1. The skb reaches to the egress function
+            # 2. The function trace reaches to the length limit
+            #
+            if fname in self._egress_functions or len(event_logs) == self._length:
+                self._pending_output.append((flow, event_logs))
+                del self._flows[flow]
 
-        event_logs = self._flows.get(flow, [])
-        event_logs.append(EventLog(tstamp, fname, custom_data))
-        self._flows[flow] = event_logs
+        self._event_buf.clear()
 
-        #
-        # Print the function trace if
-        #
-        # 1. The skb reaches to the egress function
-        # 2. The function trace reaches to the length limit
-        #
-        if fname in self._egress_functions or len(event_logs) == self._length:
+    def _flush_output(self):
+        for flow, event_logs in self._pending_output:
             self._print_function_trace(flow, event_logs)
-            del self._flows[flow]
+        self._pending_output.clear()
 
     def run_tracing(self):
         b = self._attach_probes()
         event = b["events"]
-        event.open_perf_buffer(
-            self._handle_event, lost_cb=self._handle_lost, page_cnt=64
-        )
 
+        #
+        # The ring size is declared on the BPF side, see
+        # BPF_RINGBUF_OUTPUT in ipftrace.bpf.c. Poll with a bounded
+        # timeout so that the events are drained in batches instead of
+        # waking up the consumer for every single event.
+        #
+        event.open_ring_buffer(self._make_event_callback())
+
+        #
+        # Flush the finished traces to stdout at most once per second,
+        # so that the printing doesn't steal the time from draining
+        # the ring under the load.
+        #
         print("Trace ready!")
-        while 1:
-            b.perf_buffer_poll()
+        last_flush = time.monotonic()
+        try:
+            while 1:
+                b.ring_buffer_poll(timeout=100)
+                self._process_events()
+                now = time.monotonic()
+                if now - last_flush >= 1.0:
+                    self._flush_output()
+                    last_flush = now
+        finally:
+            self._flush_output()
 
 
 @click.command()